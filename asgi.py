@@ -0,0 +1,602 @@
+"""ASGI entry point with an asyncio generation engine.
+
+Run with:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 1111
+
+`POST /generate` is served natively on an `httpx.AsyncClient`, so in-flight upstream
+calls (and their retry backoff) wait on the event loop instead of each holding an OS
+thread. Every other route is the unchanged Flask app, run through asgiref's WSGI adapter.
+Short blocking steps (SQLite reads/writes, SearXNG search) are pushed to worker threads.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+from datetime import datetime
+from http.cookies import SimpleCookie
+from zoneinfo import ZoneInfo
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+
+import app as core
+
+ASYNC_MAX_CONNECTIONS = int(os.getenv("ASYNC_MAX_CONNECTIONS", "1000"))
+
+flask_asgi = WsgiToAsgi(core.app)
+client = None
+
+
+def create_client():
+    """Create the shared async upstream client, sized from the same settings as `UpstreamClient`."""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=core.UPSTREAM_POOL_MAXSIZE
+        ),
+        timeout=httpx.Timeout(core.UPSTREAM_READ_TIMEOUT, connect=core.UPSTREAM_CONNECT_TIMEOUT)
+    )
+
+
+def in_app_context(func, *args, **kwargs):
+    """Run a Flask helper that needs `g`/`current_app` (e.g. `get_db`) and clean up after it."""
+    with core.app.app_context():
+        return func(*args, **kwargs)
+
+
+async def run_blocking(func, *args, **kwargs):
+    return await asyncio.to_thread(in_app_context, func, *args, **kwargs)
+
+
+# --- Session Cookie ---
+def load_session(scope, requested_id=None):
+    """Read the Flask session cookie so both servers share the same `session_id`.
+
+    A `requested_id` (the body's `session_id`) replaces the cookie's, as Flask's
+    `generate` does. Returns `(session_id, set_cookie_header)`; the header is None
+    unless the session was created or switched.
+    """
+    serializer = core.app.session_interface.get_signing_serializer(core.app)
+    cookie_name = core.app.config['SESSION_COOKIE_NAME']
+    session_data = {}
+
+    cookie_header = dict(scope['headers']).get(b'cookie', b'').decode('latin-1')
+    cookie = SimpleCookie()
+    cookie.load(cookie_header)
+    if cookie_name in cookie:
+        try:
+            max_age = int(core.app.permanent_session_lifetime.total_seconds())
+            session_data = serializer.loads(cookie[cookie_name].value, max_age=max_age)
+        except BadSignature:
+            session_data = {}
+
+    if requested_id and requested_id != session_data.get('session_id'):
+        session_data['session_id'] = requested_id
+    elif session_data.get('session_id'):
+        return session_data['session_id'], None
+    else:
+        session_data['session_id'] = str(uuid.uuid4())
+    set_cookie = f"{cookie_name}={serializer.dumps(session_data)}; HttpOnly; Path=/; SameSite=Lax"
+    return session_data['session_id'], set_cookie
+
+
+# --- Async Generation Engine ---
+async def chat_events(generation, max_retries=3, model_config=None):
+    """Yield token/done/error events for a prepared generation from its upstream backend.
+
+    `model_config` overrides the cloud model to call (used for failover candidates).
+
+    Mirrors `ollama_chat_stream`/`cloud_model_chat_stream`, plus the retry scheduling and
+    circuit breaker of the blocking calls. A retry is only attempted while no token has
+    been relayed yet.
+    """
+    if generation['cached']:
+        for event in core.cached_events(generation['cached']):
+            yield event
+        return
+
+    settings = core.get_settings()
+    messages = generation['messages']
+
+    if model_config is None and generation['is_cloud_model']:
+        model_config = generation['model_config']
+    if model_config is not None:
+        model_name = model_config['model_name']
+        api_url, payload, headers = core.build_cloud_request(messages, model_config, settings, stream=True)
+        parse_line = core.parse_openai_sse_line
+        trace_name = f"{model_name}::cloud_chat_generation"
+        model_parameters = {k: v for k, v in payload.items() if k != 'messages'}
+        user_id = "cloud-model-user"
+        service_label = "the cloud model"
+        provider = model_config['service']
+        breaker = core.circuit_breakers.get(core.cloud_backend_key(model_config['base_url']))
+    else:
+        model_name = generation['model']
+        api_url = f"{core.OLLAMA_BASE_URL}/api/chat"
+        payload = core.build_ollama_payload(messages, model_name, settings, stream=True)
+        headers = {'Content-Type': 'application/json'}
+        parse_line = core.parse_ollama_chunk
+        trace_name = f"{model_name}::chat_generation"
+        model_parameters = payload["options"]
+        user_id = "local-model-user"
+        service_label = provider = "Ollama"
+        breaker = core.circuit_breakers.get('ollama')
+
+    trace = None
+    if core.langfuse_enabled and not generation['is_incognito']:
+        trace = core.start_trace(trace_name, model_name, messages, model_parameters, generation['session_id'], user_id)
+
+    start_time = time.time()
+    first_token_at = None
+    chunks = []
+    usage = {}
+    error = None
+    claimed = False  # An attempt allowed by the breaker that has not reported back yet
+    try:
+        for attempt in range(max_retries):
+            if not breaker.allow():
+                yield {"type": "error", "content": core.circuit_open_message(provider, breaker)}
+                return
+            claimed = True
+            try:
+                async with client.stream('POST', api_url, json=payload, headers=headers) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        token, chunk_usage, finished = parse_line(line)
+                        if token:
+                            if first_token_at is None:
+                                first_token_at = time.time()
+                            chunks.append(token)
+                            yield {"type": "token", "content": token}
+                        if chunk_usage:
+                            usage = chunk_usage
+                        if finished:
+                            break
+                breaker.record_success()
+                claimed = False
+                break
+            except (httpx.HTTPError, ValueError) as e:
+                response = e.response if isinstance(e, httpx.HTTPStatusError) else None
+                status_code = response.status_code if response is not None else None
+                core.app.logger.error(f"Async {service_label} call failed on attempt {attempt + 1}: {e!r} - Status: {status_code}")
+                if isinstance(e, ValueError):  # An error chunk from the backend, not a transport failure
+                    breaker.release_trial()
+                    wait_time = core.retry_delay(attempt) if attempt < max_retries - 1 else None
+                else:
+                    # Tokens already sent cannot be retried, so that attempt is the call's last
+                    wait_time = core.next_retry_delay(breaker, status_code, response.headers if response is not None else None,
+                                                      attempt, attempt + 1 if chunks else max_retries, e)
+                claimed = False
+                if chunks or wait_time is None:
+                    error = e
+                    error_message = f"Error connecting to {service_label} after {attempt + 1} attempts. Please check the service status and your configuration."
+                    if status_code and status_code in core.ERROR_DESCRIPTIONS:
+                        error_message += f"\n\n**Details:** {core.ERROR_DESCRIPTIONS[status_code]}"
+                    yield {"type": "error", "content": error_message}
+                    return
+                # Back off on the event loop; no thread is held while waiting
+                await asyncio.sleep(wait_time)
+    finally:
+        if claimed:
+            # Cancelled mid-attempt (the client went away): no verdict, but a half-open trial must be handed back
+            breaker.release_trial()
+        if trace is not None:
+            completion_start = datetime.fromtimestamp(first_token_at, ZoneInfo("UTC")) if first_token_at else None
+            # Only queues the events; the trace exporter sends them off the event loop
+            core.end_trace(trace, ''.join(chunks), usage, completion_start, error)
+
+    yield {
+        "type": "done",
+        "content": ''.join(chunks) or "Sorry, I couldn't generate a response.",
+        "usage": usage,
+        "time_to_first_token": round(first_token_at - start_time, 3) if first_token_at else None
+    }
+
+
+async def failover_chat_events(generation):
+    """Async counterpart of `failover_events`: failover plus an optional hedge across cloud models.
+
+    Losing candidates are cancelled outright, which closes their upstream connections
+    and frees their admission slots. A hedge only starts when its backend has a free slot.
+    """
+    candidates = [c for c in [generation['model_config']] + generation['fallbacks'] if core.cloud_backend_ready(c)]
+    if not candidates:
+        yield {"type": "error", "content": "None of the configured cloud models is currently available."}
+        return
+
+    out = asyncio.Queue()
+    tasks = []
+    failed = set()
+    winner = None
+    last_error = None
+    started = set()
+
+    async def pump(index, release=None):
+        started.add(index)
+        # Fail over quickly: only the last candidate gets the full retry budget
+        max_retries = 3 if index == len(candidates) - 1 else 1
+        if release is None:
+            waited_from = time.perf_counter()
+            try:
+                release = await core.admission.acquire_async(core.cloud_backend_key(candidates[index]['base_url']), generation['priority'])
+            except core.AdmissionRejected as e:
+                await out.put((index, {"type": "error", "content": e.message}))
+                return
+            generation['timings'].add('admission', (time.perf_counter() - waited_from) * 1000)
+        try:
+            async for event in chat_events(generation, max_retries, candidates[index]):
+                await out.put((index, event))
+        except Exception as e:
+            core.app.logger.error(f"Unexpected error from {candidates[index]['service']} / {candidates[index]['model_name']}: {e}")
+            await out.put((index, {"type": "error", "content": "An unexpected error occurred."}))
+        finally:
+            release()
+
+    def launch(release=None):
+        index = len(tasks)
+        tasks.append(asyncio.create_task(pump(index, release)))
+        if release is not None:
+            # A task cancelled before its first step never reaches pump's `finally`
+            tasks[index].add_done_callback(lambda task: index in started or release())
+
+    launch()
+    loop = asyncio.get_running_loop()
+    hedge_at = loop.time() + generation['hedge_after'] if generation['hedge_after'] else None
+    try:
+        while True:
+            timeout = max(0, hedge_at - loop.time()) if winner is None and hedge_at is not None else None
+            try:
+                index, event = await asyncio.wait_for(out.get(), timeout)
+            except asyncio.TimeoutError:
+                hedge_at = None
+                if len(tasks) < len(candidates):
+                    hedge = candidates[len(tasks)]
+                    release = core.admission.try_acquire(core.cloud_backend_key(hedge['base_url']), generation['priority'])
+                    if release is None:
+                        core.app.logger.info(f"No token after {generation['hedge_after']}s, but {hedge['service']} / {hedge['model_name']} has no free slot; not hedging")
+                    else:
+                        core.app.logger.info(f"No token after {generation['hedge_after']}s, hedging with {hedge['service']} / {hedge['model_name']}")
+                        launch(release)
+                continue
+
+            if winner is None:
+                if event['type'] == 'error':
+                    failed.add(index)
+                    last_error = event
+                    if len(tasks) < len(candidates):
+                        launch()
+                    elif len(failed) == len(tasks):
+                        yield last_error
+                        return
+                    continue
+                winner = index
+                for other, task in enumerate(tasks):
+                    if other != winner:
+                        task.cancel()
+            if index != winner:
+                continue
+            if event['type'] == 'done':
+                event = {**event, "model_config": candidates[winner]}
+            yield event
+            if event['type'] in ('done', 'error'):
+                return
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def generation_events(generation):
+    """Event source for a prepared generation, admitted and coalesced; may raise `core.AdmissionRejected`."""
+    if generation['cached']:
+        return chat_events(generation)
+    if generation['fallbacks']:
+        events = failover_chat_events(generation)
+    else:
+        events = chat_events(generation)
+    if generation['flight_key']:
+        return await coalesce(generation, events)
+    return await admit(generation, events)
+
+
+# --- Admission Control ---
+class ReleasingEvents:
+    """Async counterpart of `core.ReleasingIterator`."""
+
+    def __init__(self, events, release):
+        self.events = events
+        self.release = release
+        self._released = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.events.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if not self._released:
+            self._released = True
+            self.release()
+            await self.events.aclose()
+
+
+async def admit(generation, events):
+    """Wait on the event loop for the backend's admission slot and hold it for `events`.
+
+    Failover generations pass through; `failover_chat_events` admits each candidate itself.
+    """
+    if generation['fallbacks']:
+        return events
+    started = time.perf_counter()
+    release = await core.admission.acquire_async(core.admission_key(generation), generation['priority'])
+    generation['timings'].add('admission', (time.perf_counter() - started) * 1000)
+    return ReleasingEvents(events, release)
+
+
+# --- Request Coalescing ---
+class AsyncFlight:
+    """asyncio counterpart of `core.Flight`, registered in the same `core.single_flight`."""
+
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self.abandoned = False
+        self.subscribers = 0
+        self.waiters = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        if event['type'] in ('done', 'error'):
+            self.finished = True
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def subscribe(self):
+        self.subscribers += 1
+        return AsyncFlightSubscription(self)
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.finished:
+            # Every attached client went away: cancel the upstream call
+            self.abandoned = True
+            if self.task is not None:
+                self.task.cancel()
+
+
+class AsyncFlightSubscription:
+    def __init__(self, flight):
+        self.flight = flight
+        self.position = 0
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flight = self.flight
+        try:
+            while not self._closed:
+                if self.position < len(flight.events):
+                    self.position += 1
+                    return flight.events[self.position - 1]
+                if flight.finished:
+                    break
+                await flight._changed.wait()
+        except BaseException:
+            await self.aclose()
+            raise
+        await self.aclose()
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self.flight.unsubscribe()
+
+
+async def produce_flight(key, flight, events):
+    try:
+        async for event in events:
+            flight.publish(event)
+    except Exception as e:
+        core.app.logger.error(f"Error in coalesced async generation: {e}")
+        flight.publish({"type": "error", "content": "An unexpected error occurred."})
+    finally:
+        await events.aclose()
+        if not flight.finished:
+            flight.publish({"type": "error", "content": "The generation was cancelled."})
+        core.single_flight.finish(key, flight)
+
+
+async def coalesce(generation, events):
+    """Attach a generation to an identical in-flight one, or lead a new flight once admitted."""
+    key = generation['flight_key']
+    flight, is_leader = core.single_flight.join(key, AsyncFlight)
+    subscription = flight.subscribe()
+    if not is_leader:
+        generation['coalesced'] = True
+        core.app.logger.info(f"Coalesced async generation for session {generation['session_id']} ({flight.waiters} waiting)")
+        return subscription
+
+    try:
+        events = await admit(generation, events)
+    except BaseException as e:
+        await subscription.aclose()
+        if not flight.finished:
+            message = e.message if isinstance(e, core.AdmissionRejected) else "The generation was cancelled."
+            flight.publish({"type": "error", "content": message})
+        core.single_flight.finish(key, flight)
+        raise
+    flight.task = asyncio.create_task(produce_flight(key, flight, events))
+    return subscription
+
+
+# --- ASGI Plumbing ---
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def send_json(send, body, status=200, set_cookie=None, retry_after=None, server_timing=None):
+    headers = [(b'content-type', b'application/json')]
+    if set_cookie:
+        headers.append((b'set-cookie', set_cookie.encode('latin-1')))
+    if retry_after is not None:
+        headers.append((b'retry-after', str(retry_after).encode('latin-1')))
+    if server_timing:
+        headers.append((b'server-timing', server_timing.encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': json.dumps(body).encode('utf-8')})
+
+
+async def handle_generate(scope, receive, send):
+    """Async equivalent of the Flask `generate()` view."""
+    global client
+    if client is None:  # Servers started with lifespan events disabled
+        client = create_client()
+
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        data = json.loads(body or b'null')
+    except ValueError:
+        await send_json(send, {"error": "Request body must be valid JSON"}, 400)
+        return
+
+    session_id, set_cookie = load_session(scope, data.get('session_id') if isinstance(data, dict) else None)
+
+    # Worker threads started through run_blocking inherit this, so their phases are counted too
+    timings = core.PhaseTimings()
+    core.current_timings.set(timings)
+    with timings.phase('readiness'):
+        unavailable = await run_blocking(core.backend_unavailable, (data or {}).get('model', core.OLLAMA_MODEL),
+                                         core.failover_configured(data))
+    if unavailable:
+        await send_json(send, unavailable[0], unavailable[1], set_cookie)
+        return
+
+    async def relay():
+        generation, error = await run_blocking(core.prepare_generation, data, session_id, timings)
+        if error:
+            await send_json(send, error[0], error[1], set_cookie)
+            return
+
+        try:
+            events = await generation_events(generation)
+        except core.AdmissionRejected as e:
+            core.app.logger.warning(f"Async generation for session {session_id} rejected by admission control: {e.message}")
+            await send_json(send, {"error": e.message, "retry_after": e.retry_after}, e.status, set_cookie, e.retry_after)
+            return
+
+        try:
+            await respond(generation, events)
+        finally:
+            await events.aclose()
+
+    async def respond(generation, events):
+        if data.get('stream'):
+            headers = [(b'content-type', b'application/x-ndjson'),
+                       (b'server-timing', timings.header().encode('latin-1'))]
+            if set_cookie:
+                headers.append((b'set-cookie', set_cookie.encode('latin-1')))
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            upstream_started = time.perf_counter()
+            async for event in events:
+                if event['type'] == 'done':
+                    timings.add('upstream', (time.perf_counter() - upstream_started) * 1000)
+                    if event.get('model_config'):
+                        core.record_answering_backend(generation, event['model_config'])
+                    elapsed = time.time() - generation['start_time']
+                    event = {"type": "done", **await run_blocking(
+                        core.finish_generation, generation, event['content'], event['usage'],
+                        elapsed, event['time_to_first_token']
+                    )}
+                line = (json.dumps(event) + '\n').encode('utf-8')
+                await send({'type': 'http.response.body', 'body': line, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        # Non-streaming requests get the same single JSON body as the Flask view,
+        # including returning the final error text as the assistant message.
+        content, usage, time_to_first_token, failed = '', {}, None, False
+        upstream_started = time.perf_counter()
+        async for event in events:
+            if event.get('model_config'):
+                core.record_answering_backend(generation, event['model_config'])
+            if event['type'] in ('done', 'error'):
+                content = event['content']
+                usage = event.get('usage', {})
+                time_to_first_token = event.get('time_to_first_token')
+                failed = event['type'] == 'error'
+        timings.add('upstream', (time.perf_counter() - upstream_started) * 1000)
+        elapsed = time.time() - generation['start_time']
+        response_body = await run_blocking(core.finish_generation, generation, content, usage, elapsed,
+                                           time_to_first_token, failed)
+        await send_json(send, response_body, 200, set_cookie, server_timing=timings.header())
+
+    # Cancel the upstream call (and skip saving) if the user presses Stop
+    relay_task = asyncio.create_task(relay())
+    disconnect_task = asyncio.create_task(wait_for_disconnect(receive))
+    done, _ = await asyncio.wait({relay_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    if relay_task in done:
+        disconnect_task.cancel()
+        try:
+            relay_task.result()
+        except Exception as e:
+            core.app.logger.error(f"Error during async generation: {e}")
+            try:
+                await send_json(send, {"error": "Internal generation error"}, 500)
+            except Exception:
+                pass  # The streamed response had already started
+    else:
+        relay_task.cancel()
+        core.app.logger.info(f"Client disconnected, async generation for session {session_id} cancelled. No data will be saved.")
+
+
+async def handle_lifespan(receive, send):
+    global client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            client = create_client()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if client is not None:
+                await client.aclose()
+            await asyncio.to_thread(core.trace_exporter.shutdown)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
+        return
+    if scope['type'] == 'http' and scope['path'] == '/generate' and scope['method'] == 'POST':
+        await handle_generate(scope, receive, send)
+        return
+    await flask_asgi(scope, receive, send)
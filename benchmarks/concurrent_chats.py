@@ -0,0 +1,171 @@
+"""Compare how many concurrent chats the threaded Flask server and the ASGI engine sustain.
+
+Starts `stub_upstream.py` as a slow Ollama, then runs the app twice — `app.run(threaded=True)`
+(as `main.py` does) and `uvicorn asgi:app` — against a fresh SQLite file. For each
+concurrency level it fires that many simultaneous `/generate` requests and records
+success rate, latency and the server's peak thread count and RSS.
+
+    python benchmarks/concurrent_chats.py --levels 50,200,800,1600 --delay 5
+
+The reported "max concurrent chats" is the highest level where every request succeeded
+within `--timeout`. Results are printed and written as JSON to `--output`.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'flask-threaded': [sys.executable, '-c',
+                       "import os; from app import app; app.run(host='127.0.0.1', port=int(os.environ['BENCH_PORT']), threaded=True)"],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1',
+             '--port', '{port}', '--log-level', 'warning', '--backlog', '4096'],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))], 3)
+
+
+async def sample_process(proc, stop, peaks):
+    while not stop.is_set():
+        try:
+            peaks['threads'] = max(peaks['threads'], proc.num_threads())
+            peaks['rss_mb'] = max(peaks['rss_mb'], round(proc.memory_info().rss / 2**20, 1))
+        except psutil.Error:
+            break
+        await asyncio.sleep(0.1)
+
+
+async def run_level(port, concurrency, timeout, server_proc, stream):
+    latencies, failures = [], 0
+    peaks = {'threads': 0, 'rss_mb': 0}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_process(server_proc, stop, peaks))
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=0)
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=timeout) as client:
+        async def one_chat(i):
+            nonlocal failures
+            start = time.perf_counter()
+            try:
+                response = await client.post('/generate', json={
+                    "messages": [], "model": "stub:latest", "incognito": True, "stream": stream,
+                    "newMessage": {"role": "user", "content": f"benchmark message {i}"},
+                })
+                await response.aread()
+                if response.status_code != 200:
+                    failures += 1
+                    return
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError:
+                failures += 1
+
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(one_chat(i) for i in range(concurrency)))
+        wall = time.perf_counter() - wall_start
+
+    stop.set()
+    await sampler
+    return {
+        'concurrency': concurrency,
+        'succeeded': len(latencies),
+        'failed': failures,
+        'wall_seconds': round(wall, 2),
+        'p50_seconds': percentile(latencies, 50),
+        'p99_seconds': percentile(latencies, 99),
+        'peak_server_threads': peaks['threads'],
+        'peak_server_rss_mb': peaks['rss_mb'],
+    }
+
+
+def run_server(name, levels, args, upstream_url, workdir):
+    port = free_port()
+    # Admission control would otherwise queue the stub behind a one-at-a-time Ollama limit
+    env = dict(os.environ, OLLAMA_BASE_URL=upstream_url, BENCH_PORT=str(port),
+               SQLITE_DATABASE=os.path.join(workdir, f'{name}.db'), FLASK_DEBUG='false',
+               ADMISSION_OLLAMA_CONCURRENCY=str(max(levels)), ADMISSION_QUEUE_SIZE=str(max(levels)))
+    command = [part.format(port=port) for part in SERVERS[name]]
+    proc = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_for_port(port)
+        server_proc = psutil.Process(proc.pid)
+        for level in levels:
+            result = asyncio.run(run_level(port, level, args.timeout, server_proc, args.stream))
+            print(f"  {name:15} {json.dumps(result)}")
+            results.append(result)
+            if result['failed'] and not args.keep_going:
+                break
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    passing = [r['concurrency'] for r in results if r['failed'] == 0]
+    return {'levels': results, 'max_concurrent_chats': max(passing) if passing else 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--levels', default='50,100,200,400,800,1600')
+    parser.add_argument('--delay', type=float, default=5.0, help="Seconds each upstream chat takes")
+    parser.add_argument('--timeout', type=float, default=60.0, help="Per-request client timeout")
+    parser.add_argument('--stream', action='store_true', help="Use streaming /generate requests")
+    parser.add_argument('--servers', default=','.join(SERVERS))
+    parser.add_argument('--keep-going', action='store_true', help="Continue past the first failing level")
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(',')]
+
+    upstream_port = free_port()
+    stub = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'stub_upstream.py'),
+                             '--port', str(upstream_port), '--delay', str(args.delay)])
+    report = {'delay_seconds': args.delay, 'stream': args.stream, 'servers': {}}
+    try:
+        wait_for_port(upstream_port)
+        with tempfile.TemporaryDirectory() as workdir:
+            for name in args.servers.split(','):
+                print(f"Benchmarking {name}...")
+                report['servers'][name] = run_server(name, levels, args, f"http://127.0.0.1:{upstream_port}", workdir)
+    finally:
+        stub.terminate()
+
+    print("\nMax concurrent chats:")
+    for name, result in report['servers'].items():
+        print(f"  {name:15} {result['max_concurrent_chats']}")
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
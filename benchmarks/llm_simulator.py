@@ -0,0 +1,374 @@
+"""Deterministic Ollama and OpenAI-compatible backend for offline testing.
+
+Speaks Ollama's `/api/chat`, `/api/tags`, `/api/pull`, `/api/ps`, `/api/show`, `/api/generate`
+(load/unload) and `/api/delete`, plus OpenAI's `/chat/completions` and `/models` (with or
+without a `/v1` prefix), streaming and non-streaming. Point the app at it with
+`OLLAMA_BASE_URL=http://127.0.0.1:11600` or a cloud model whose `base_url` is
+`http://127.0.0.1:11600/v1` (any API key).
+
+    python benchmarks/llm_simulator.py --port 11600 --prefill-ms 300 --tokens-per-second 40
+    python benchmarks/llm_simulator.py --error-rate 0.05 --burst-every 60 --burst-length 10
+
+Replies are derived from a hash of the conversation and `--seed`, so the same prompt always
+gets the same text and token counts. Faults (`--error-rate` 500s, `--drop-rate` streams cut
+off mid-reply, `--burst-every`/`--burst-length` windows of 429s with Retry-After) come from
+a seeded RNG, so a run with the same request order fails the same way. `GET /_sim/stats`
+returns request counts, faults and the total time the simulator spent "generating", which is
+what to subtract from client latency to get the app's own overhead. Like `stub_upstream.py`
+it is built on bare asyncio, so it is never the bottleneck.
+"""
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import argparse
+from collections import Counter
+from datetime import datetime, timezone
+
+WORDS = ("the a model answer request stream token latency cache session prompt context reply "
+         "system user data result value server client queue batch trace error retry window").split()
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def count_tokens(text):
+    """Rough prompt size, ~4 characters per token like most BPE tokenizers."""
+    return max(1, len(text) // 4)
+
+
+class Simulator:
+    def __init__(self, args):
+        self.args = args
+        self.models = dict.fromkeys(args.models.split(','))
+        self.loaded = {}  # model -> expiry timestamp (None = kept loaded)
+        self.rng = random.Random(args.seed)
+        self.started = time.monotonic()
+        self.stats = Counter()
+        self.simulated_seconds = 0.0
+
+    # --- Behaviour ---
+    def fault(self, stream):
+        """`(status, body, headers)` for an injected failure, 'drop' for a cut stream, or None."""
+        args = self.args
+        if args.burst_every:
+            into_window = (time.monotonic() - self.started) % args.burst_every
+            if into_window < args.burst_length:
+                self.stats['faults_429'] += 1
+                retry_after = args.retry_after or math.ceil(args.burst_length - into_window)
+                return 429, {"error": "simulated rate limit"}, {'Retry-After': str(retry_after)}
+        if args.error_rate and self.rng.random() < args.error_rate:
+            self.stats['faults_500'] += 1
+            return 500, {"error": "simulated server error"}, {}
+        if stream and args.drop_rate and self.rng.random() < args.drop_rate:
+            self.stats['faults_dropped'] += 1
+            return 'drop'
+        return None
+
+    def reply(self, messages, max_tokens):
+        """Deterministic reply tokens for a conversation, plus its prompt token count."""
+        transcript = json.dumps(messages, sort_keys=True)
+        rng = random.Random(hashlib.sha256(f"{self.args.seed}:{transcript}".encode()).hexdigest())
+        length = self.args.response_tokens
+        if self.args.response_jitter:
+            length = max(1, round(length * rng.uniform(1 - self.args.response_jitter, 1 + self.args.response_jitter)))
+        if max_tokens and max_tokens > 0:
+            length = min(length, max_tokens)
+        tokens = [rng.choice(WORDS) + ' ' for _ in range(length)]
+        tokens[0] = tokens[0].capitalize()
+        tokens[-1] = tokens[-1].rstrip() + '.'
+        prompt = sum(count_tokens(str(message.get('content') or '')) + 4 for message in messages)
+        return tokens, prompt
+
+    def prefill_seconds(self, prompt_tokens):
+        return (self.args.prefill_ms + self.args.prefill_ms_per_1k * prompt_tokens / 1000) / 1000
+
+    def touch(self, model, keep_alive=None):
+        if keep_alive in (0, '0'):
+            self.loaded.pop(model, None)
+        elif isinstance(keep_alive, (int, float)) and keep_alive < 0:
+            self.loaded[model] = None
+        else:
+            self.loaded[model] = time.time() + 300
+
+    def known(self, model):
+        return not self.args.strict_models or model in self.models
+
+    # --- Ollama ---
+    def tag(self, model):
+        digest = hashlib.sha256(model.encode()).hexdigest()
+        return {"name": model, "model": model, "modified_at": now_iso(), "size": self.args.model_size_mb * 2**20,
+                "digest": digest, "details": {"format": "gguf", "family": "simulated", "parameter_size": "1B",
+                                              "quantization_level": "Q4_0"}}
+
+    def ps(self):
+        models = []
+        for model, expires in list(self.loaded.items()):
+            if expires is not None and expires < time.time():
+                del self.loaded[model]
+                continue
+            expires_at = datetime.fromtimestamp(expires, timezone.utc) if expires else datetime(2318, 1, 1, tzinfo=timezone.utc)
+            models.append(dict(self.tag(model), expires_at=expires_at.isoformat(),
+                               size_vram=self.args.model_size_mb * 2**20))
+        return {"models": models}
+
+    async def ollama_chat(self, conn, payload):
+        model = payload.get('model', '')
+        if not self.known(model):
+            return await conn.send_json(404, {"error": f"model '{model}' not found"})
+        stream = payload.get('stream', True)
+        fault = self.fault(stream)
+        if fault and fault != 'drop':
+            return await conn.send_json(*fault)
+        tokens, prompt_tokens = self.reply(payload.get('messages') or [], (payload.get('options') or {}).get('num_predict'))
+        self.touch(model, payload.get('keep_alive'))
+        prefill = self.prefill_seconds(prompt_tokens)
+        per_token = 1 / self.args.tokens_per_second
+        final = {"model": model, "created_at": now_iso(), "message": {"role": "assistant", "content": ""},
+                 "done": True, "done_reason": "stop"}
+        if self.args.usage == 'full':
+            final.update(total_duration=int((prefill + per_token * len(tokens)) * 1e9), load_duration=0,
+                         prompt_eval_count=prompt_tokens, prompt_eval_duration=int(prefill * 1e9),
+                         eval_count=len(tokens), eval_duration=int(per_token * len(tokens) * 1e9))
+
+        if not stream:
+            await self.generate_time(prefill + per_token * len(tokens))
+            final['message']['content'] = ''.join(tokens)
+            return await conn.send_json(200, final)
+
+        await conn.start_chunked('application/x-ndjson')
+        await self.generate_time(prefill)
+        for i, token in enumerate(tokens):
+            if fault == 'drop' and i == len(tokens) // 2:
+                return conn.abort()
+            await self.generate_time(per_token)
+            await conn.send_chunk(json.dumps({"model": model, "created_at": now_iso(),
+                                              "message": {"role": "assistant", "content": token}, "done": False}) + '\n')
+        await conn.send_chunk(json.dumps(final) + '\n')
+        await conn.end_chunked()
+
+    async def ollama_pull(self, conn, payload):
+        model = payload.get('model') or payload.get('name')
+        if not model:
+            return await conn.send_json(400, {"error": "model is required"})
+        digest = 'sha256:' + hashlib.sha256(model.encode()).hexdigest()
+        total = self.args.model_size_mb * 2**20
+        steps = [{"status": "pulling manifest"}]
+        steps += [{"status": f"pulling {digest[7:19]}", "digest": digest, "total": total, "completed": total * i // 4}
+                  for i in range(1, 5)]
+        steps += [{"status": "verifying sha256 digest"}, {"status": "writing manifest"}, {"status": "success"}]
+        self.models[model] = None
+        if not payload.get('stream', True):
+            await self.generate_time(self.args.pull_seconds)
+            return await conn.send_json(200, {"status": "success"})
+        await conn.start_chunked('application/x-ndjson')
+        for step in steps:
+            await self.generate_time(self.args.pull_seconds / len(steps))
+            await conn.send_chunk(json.dumps(step) + '\n')
+        await conn.end_chunked()
+
+    # --- OpenAI ---
+    async def openai_chat(self, conn, payload):
+        model = payload.get('model', '')
+        if not self.known(model):
+            return await conn.send_json(404, {"error": {"message": f"The model `{model}` does not exist", "type": "invalid_request_error"}})
+        stream = bool(payload.get('stream'))
+        fault = self.fault(stream)
+        if fault and fault != 'drop':
+            status, body, headers = fault
+            return await conn.send_json(status, {"error": {"message": body['error'], "type": "simulated"}}, headers)
+        tokens, prompt_tokens = self.reply(payload.get('messages') or [], payload.get('max_tokens'))
+        prefill = self.prefill_seconds(prompt_tokens)
+        per_token = 1 / self.args.tokens_per_second
+        completion_id = f"chatcmpl-{uuid.UUID(int=self.rng.getrandbits(128)).hex}"
+        created = int(time.time())
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+
+        if not stream:
+            await self.generate_time(prefill + per_token * len(tokens))
+            body = {"id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": ''.join(tokens)},
+                                 "finish_reason": "stop"}]}
+            if self.args.usage == 'full':
+                body['usage'] = usage
+            return await conn.send_json(200, body)
+
+        def chunk(delta, finish_reason=None):
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        await conn.start_chunked('text/event-stream')
+        await self.generate_time(prefill)
+        await conn.send_chunk(f"data: {json.dumps(chunk({'role': 'assistant', 'content': ''}))}\n\n")
+        for i, token in enumerate(tokens):
+            if fault == 'drop' and i == len(tokens) // 2:
+                return conn.abort()
+            await self.generate_time(per_token)
+            await conn.send_chunk(f"data: {json.dumps(chunk({'content': token}))}\n\n")
+        await conn.send_chunk(f"data: {json.dumps(chunk({}, 'stop'))}\n\n")
+        if self.args.usage == 'full' and (payload.get('stream_options') or {}).get('include_usage'):
+            await conn.send_chunk(f"data: {json.dumps(dict(chunk({}), choices=[], usage=usage))}\n\n")
+        await conn.send_chunk("data: [DONE]\n\n")
+        await conn.end_chunked()
+
+    async def generate_time(self, seconds):
+        self.simulated_seconds += seconds
+        await asyncio.sleep(seconds)
+
+    # --- Routing ---
+    async def dispatch(self, conn, method, path, body):
+        route = path[3:] if path.startswith('/v1/') else path
+        self.stats[f"{method} {route}"] += 1
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return await conn.send_json(400, {"error": "invalid JSON body"})
+
+        if method == 'POST' and route == '/api/chat':
+            await self.ollama_chat(conn, payload)
+        elif method == 'POST' and route == '/chat/completions':
+            await self.openai_chat(conn, payload)
+        elif method == 'GET' and route == '/api/tags':
+            await conn.send_json(200, {"models": [self.tag(model) for model in self.models]})
+        elif method == 'GET' and route == '/api/ps':
+            await conn.send_json(200, self.ps())
+        elif method == 'POST' and route == '/api/pull':
+            await self.ollama_pull(conn, payload)
+        elif method == 'POST' and route == '/api/generate':
+            # Only load/unload requests are supported: `{"model": ..., "keep_alive": ...}` without a prompt
+            self.touch(payload.get('model', ''), payload.get('keep_alive'))
+            await conn.send_json(200, {"model": payload.get('model'), "created_at": now_iso(), "response": "", "done": True})
+        elif method == 'POST' and route == '/api/show':
+            model = payload.get('model') or payload.get('name', '')
+            await conn.send_json(200, {"parameters": f"num_ctx {self.args.num_ctx}",
+                                       "model_info": {"simulated.context_length": self.args.num_ctx},
+                                       "details": self.tag(model)['details']})
+        elif method == 'DELETE' and route == '/api/delete':
+            model = payload.get('model') or payload.get('name', '')
+            if model not in self.models:
+                return await conn.send_json(404, {"error": f"model '{model}' not found"})
+            del self.models[model]
+            self.loaded.pop(model, None)
+            await conn.send_json(200, {})
+        elif method == 'GET' and route == '/models':
+            await conn.send_json(200, {"object": "list", "data": [
+                {"id": model, "object": "model", "created": 0, "owned_by": "simulator"} for model in self.models]})
+        elif method == 'GET' and route in ('/', '/api/version'):
+            await conn.send_json(200, {"version": "0.0.0-simulator"})
+        elif method == 'GET' and route == '/_sim/stats':
+            await conn.send_json(200, {"uptime_seconds": round(time.monotonic() - self.started, 1),
+                                       "simulated_seconds": round(self.simulated_seconds, 3),
+                                       "loaded_models": list(self.loaded), **dict(self.stats)})
+        else:
+            await conn.send_json(404, {"error": "not found"})
+
+
+class Connection:
+    """Minimal HTTP/1.1 writer: JSON responses and chunked streams over one keep-alive socket."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.aborted = False
+
+    async def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        extra = ''.join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        self.writer.write(
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n{extra}Connection: keep-alive\r\n\r\n".encode('latin-1') + payload
+        )
+        await self.writer.drain()
+
+    async def start_chunked(self, content_type):
+        self.writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n"
+                          f"Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n".encode('latin-1'))
+        await self.writer.drain()
+
+    async def send_chunk(self, text):
+        data = text.encode()
+        self.writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        await self.writer.drain()
+
+    async def end_chunked(self):
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+    def abort(self):
+        """Cut the connection mid-response, like a crashed or restarted backend."""
+        self.aborted = True
+        self.writer.transport.abort()
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = b''
+    if int(headers.get('content-length', 0)):
+        body = await reader.readexactly(int(headers['content-length']))
+    return method, path.split('?', 1)[0].rstrip('/') or '/', body
+
+
+async def handle(reader, writer, simulator):
+    conn = Connection(writer)
+    try:
+        while not conn.aborted:
+            request = await read_request(reader)
+            if request is None:
+                break
+            await simulator.dispatch(conn, *request)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args):
+    simulator = Simulator(args)
+    server = await asyncio.start_server(lambda r, w: handle(r, w, simulator), args.host, args.port, backlog=4096)
+    print(f"LLM simulator listening on http://{args.host}:{args.port} (models: {', '.join(simulator.models)})")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11600)
+    parser.add_argument('--models', default='sim:latest', help="Comma-separated models listed by /api/tags and /models")
+    parser.add_argument('--strict-models', action='store_true', help="404 for chats with unlisted models")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--prefill-ms', type=float, default=200.0, help="Fixed time before the first token")
+    parser.add_argument('--prefill-ms-per-1k', type=float, default=50.0, help="Extra prefill per 1000 prompt tokens")
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--response-tokens', type=int, default=64, help="Reply length (capped by num_predict/max_tokens)")
+    parser.add_argument('--response-jitter', type=float, default=0.0, help="Vary reply length by up to this fraction")
+    parser.add_argument('--usage', choices=('full', 'none'), default='full',
+                        help="'none' omits token counts, like providers that do not report usage")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of chats answered with a 500")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Fraction of streamed chats cut off halfway")
+    parser.add_argument('--burst-every', type=float, default=0.0, help="Start a 429 burst every N seconds")
+    parser.add_argument('--burst-length', type=float, default=5.0, help="Seconds each 429 burst lasts")
+    parser.add_argument('--retry-after', type=int, default=0, help="Retry-After for 429s (default: until the burst ends)")
+    parser.add_argument('--num-ctx', type=int, default=8192, help="Context length reported by /api/show")
+    parser.add_argument('--model-size-mb', type=int, default=1024, help="Model size reported by /api/tags and /api/ps")
+    parser.add_argument('--pull-seconds', type=float, default=1.0, help="How long /api/pull takes")
+    args = parser.parse_args()
+    if args.tokens_per_second <= 0:
+        parser.error("--tokens-per-second must be positive")
+    asyncio.run(serve(args))
@@ -0,0 +1,184 @@
+"""Compare Ollama prefill time with 'stable' and 'inline' prompt assembly.
+
+Runs the app (`app.run(threaded=True)`, as `main.py` does) against a real Ollama through
+a small recording proxy that notes `prompt_eval_count` and `prompt_eval_duration` from
+every /api/chat reply. For each mode it uploads the same document into a fresh session
+and asks `--turns` questions, sending `prompt_assembly` with each /generate call. The
+model is unloaded between modes so both start from an empty prompt cache.
+
+    python benchmarks/prompt_assembly.py --model llama3.2:3b --turns 6
+
+Ollama only evaluates the part of a prompt after the longest prefix it still has
+cached, so the layout that keeps the document in a fixed leading block should show a
+much smaller `prompt_eval_duration` from the second turn on. Results are printed and
+written as JSON to `--output`.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('inline', 'stable')
+
+QUESTIONS = [
+    "Give a one-paragraph overview of this document.",
+    "Which configuration options does it mention?",
+    "What happens when a request fails?",
+    "List the endpoints that change data.",
+    "Which parts would you test first, and why?",
+    "Summarize our conversation so far in two sentences.",
+]
+
+SERVER = [sys.executable, '-c',
+          "import os; from app import app; app.run(host='127.0.0.1', port=int(os.environ['BENCH_PORT']), threaded=True)"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def start_recording_proxy(ollama_url, records):
+    """Forward everything to Ollama and record the prefill stats of each /api/chat reply."""
+    upstream = httpx.Client(base_url=ollama_url, timeout=None)
+
+    class Handler(BaseHTTPRequestHandler):
+        def _forward(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            response = upstream.request(self.command, self.path, content=body,
+                                        headers={'Content-Type': self.headers.get('Content-Type', 'application/json')})
+            if self.path.startswith('/api/chat'):
+                # Non-streaming replies are one JSON object; streaming ones end with the stats line
+                lines = [line for line in response.content.splitlines() if line.strip()]
+                try:
+                    final = json.loads(lines[-1]) if lines else {}
+                except ValueError:
+                    final = {}
+                if 'prompt_eval_duration' in final:
+                    records.append({'prompt_eval_count': final.get('prompt_eval_count', 0),
+                                    'prompt_eval_ms': round(final['prompt_eval_duration'] / 1e6, 1)})
+            self.send_response(response.status_code)
+            self.send_header('Content-Type', response.headers.get('content-type', 'application/json'))
+            self.send_header('Content-Length', str(len(response.content)))
+            self.end_headers()
+            self.wfile.write(response.content)
+
+        do_GET = do_POST = do_DELETE = _forward
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def unload_model(ollama_url, model):
+    httpx.post(f"{ollama_url}/api/generate", json={"model": model, "keep_alive": 0}, timeout=60)
+
+
+def run_mode(mode, app_url, args, document_path, records):
+    turns = []
+    with httpx.Client(base_url=app_url, timeout=args.timeout) as client:
+        with open(document_path, 'rb') as f:
+            client.post('/upload', files={'file': ('benchmark_document.txt', f, 'text/plain')}).raise_for_status()
+        history_version = None
+        for i in range(args.turns):
+            question = QUESTIONS[i % len(QUESTIONS)]
+            body = {"model": args.model, "newMessage": {"role": "user", "content": question},
+                    "prompt_assembly": mode, "stream": False}
+            body.update({"history_version": history_version} if history_version else {"messages": []})
+            mark = len(records)
+            response = client.post('/generate', json=body)
+            response.raise_for_status()
+            data = response.json()
+            history_version = data.get('history_version')
+            calls = records[mark:]
+            turn = {
+                'turn': i + 1,
+                'prompt_eval_count': sum(c['prompt_eval_count'] for c in calls),
+                'prompt_eval_ms': round(sum(c['prompt_eval_ms'] for c in calls), 1),
+                'generation_time_seconds': data.get('generation_time_seconds'),
+            }
+            print(f"  {mode:7} {json.dumps(turn)}")
+            turns.append(turn)
+    follow_ups = [t['prompt_eval_ms'] for t in turns[1:]]
+    return {
+        'turns': turns,
+        'first_turn_prompt_eval_ms': turns[0]['prompt_eval_ms'] if turns else None,
+        'mean_follow_up_prompt_eval_ms': round(sum(follow_ups) / len(follow_ups), 1) if follow_ups else None,
+        'total_prompt_eval_ms': round(sum(t['prompt_eval_ms'] for t in turns), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', required=True, help="Installed Ollama model to chat with")
+    parser.add_argument('--ollama-url', default=os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434'))
+    parser.add_argument('--document', default=os.path.join(ROOT, 'documentation', 'backend.md'),
+                        help="Text file to upload as the conversation's document")
+    parser.add_argument('--doc-chars', type=int, default=8000, help="Truncate the document so it fits the model's window")
+    parser.add_argument('--turns', type=int, default=6)
+    parser.add_argument('--num-predict', type=int, default=128)
+    parser.add_argument('--timeout', type=float, default=600.0, help="Per-request client timeout")
+    parser.add_argument('--output', default='bench_prompt_assembly.json')
+    args = parser.parse_args()
+
+    records = []
+    proxy, proxy_url = start_recording_proxy(args.ollama_url, records)
+    report = {'model': args.model, 'turns': args.turns, 'doc_chars': args.doc_chars, 'modes': {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        document_path = os.path.join(workdir, 'document.txt')
+        with open(args.document, encoding='utf-8') as src, open(document_path, 'w', encoding='utf-8') as dst:
+            dst.write(src.read()[:args.doc_chars])
+
+        port = free_port()
+        # Caching, coalescing and background summaries would hide or add upstream calls
+        env = dict({'TOP_P': '0.9', 'TOP_K': '40'}, **os.environ)
+        env.update(OLLAMA_BASE_URL=proxy_url, BENCH_PORT=str(port), FLASK_DEBUG='false',
+                   SQLITE_DATABASE=os.path.join(workdir, 'bench.db'), NUM_PREDICT=str(args.num_predict),
+                   TEMPERATURE='0', RESPONSE_CACHE_ENABLED='false', COALESCE_REQUESTS='false',
+                   CONTEXT_SUMMARIZE='false', WARM_POOL_MODELS='')
+        proc = subprocess.Popen(SERVER, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            for mode in MODES:
+                print(f"Benchmarking {mode} prompt assembly...")
+                unload_model(args.ollama_url, args.model)
+                report['modes'][mode] = run_mode(mode, f"http://127.0.0.1:{port}", args, document_path, records)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+            proxy.shutdown()
+
+    print("\nMean prompt_eval_duration after the first turn:")
+    for mode, result in report['modes'].items():
+        print(f"  {mode:7} {result['mean_follow_up_prompt_eval_ms']} ms (first turn {result['first_turn_prompt_eval_ms']} ms)")
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
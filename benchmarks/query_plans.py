@@ -0,0 +1,154 @@
+"""Show how the schema migrations' indexes change SQLite query plans and latency.
+
+Builds a throwaway database at the baseline schema (migration 1, no secondary indexes),
+fills it with `--messages` messages across `--sessions` sessions and `--usage-rows`
+usage metrics spread over `--days` days, and times the app's hot queries (conversation
+load, session files, regeneration lookup, dashboard range queries). It then applies the
+remaining migrations with the app's own `migrate()`, runs each query once and closes the
+connection with `optimize_db()` the way `close_db()` periodically does (it samples planner statistics), and
+then times the same queries again.
+
+    python benchmarks/query_plans.py --messages 1000000 --usage-rows 1000000
+
+For each query the `EXPLAIN QUERY PLAN` and the median time over `--repeat` runs are
+printed before and after; the report is also written as JSON to `--output`. Importing
+the app needs its requirements installed; its own database goes to a temporary file.
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (SQL, function building its parameters); mirrors the queries in app.py
+QUERIES = {
+    'conversation': ("SELECT sender, content FROM messages WHERE session_id = ? ORDER BY timestamp ASC, id ASC",
+                     lambda ctx: (ctx['rng'].choice(ctx['sessions']),)),
+    'session_files': ("SELECT content FROM messages WHERE session_id = ? AND sender = 'system' ORDER BY timestamp ASC, id ASC",
+                      lambda ctx: (ctx['rng'].choice(ctx['sessions']),)),
+    'regenerate_last_pair': ("SELECT id FROM messages WHERE session_id = ? ORDER BY timestamp DESC LIMIT 2",
+                             lambda ctx: (ctx['rng'].choice(ctx['sessions']),)),
+    'dashboard_recent_usage': ("SELECT model, category, session_id, input_tokens_per_message, output_tokens_per_message, cached "
+                               "FROM api_usage_metrics WHERE timestamp >= ? ORDER BY timestamp DESC LIMIT 100",
+                               lambda ctx: (ctx['since'],)),
+    'dashboard_token_sums': ("SELECT SUM(input_tokens_per_message), SUM(output_tokens_per_message) "
+                             "FROM api_usage_metrics WHERE timestamp >= ? AND NOT cached",
+                             lambda ctx: (ctx['since'],)),
+    'dashboard_calls_per_model': ("SELECT model, COUNT(id) AS call_count FROM api_usage_metrics WHERE timestamp >= ? "
+                                  "GROUP BY model ORDER BY call_count DESC",
+                                  lambda ctx: (ctx['since'],)),
+}
+
+MODELS = ['gemma3:1b', 'llama3.2:3b', 'qwen2.5:7b', '(OpenAI) gpt-4o-mini', '(OpenAI) gpt-4o', '(Perplexity) sonar']
+
+
+def load_app(workdir):
+    """Import app.py with its own database in `workdir`, for `migrate()`."""
+    os.environ['SQLITE_DATABASE'] = os.path.join(workdir, 'app.db')
+    os.environ.setdefault('TOP_P', '0.9')
+    os.environ.setdefault('TOP_K', '40')
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+def seed(db, args, rng):
+    now = datetime.utcnow()
+    span = timedelta(days=args.days).total_seconds()
+
+    def stamp():
+        return str(now - timedelta(seconds=rng.uniform(0, span)))[:19]
+
+    sessions = [f"session-{i:06d}" for i in range(args.sessions)]
+    senders = ['user', 'assistant', 'user', 'assistant', 'user', 'assistant', 'system']
+    db.executemany('INSERT INTO messages (session_id, sender, content, timestamp) VALUES (?, ?, ?, ?)', (
+        (rng.choice(sessions), rng.choice(senders), f"message {i}", stamp()) for i in range(args.messages)
+    ))
+    db.executemany('INSERT INTO api_usage_metrics (model, category, session_id, input_tokens_per_message, '
+                   'output_tokens_per_message, cached, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)', (
+        (rng.choice(MODELS), 'chat', rng.choice(sessions), rng.randint(50, 4000), rng.randint(20, 1200),
+         int(rng.random() < 0.1), stamp()) for _ in range(args.usage_rows)
+    ))
+    db.commit()
+    return sessions
+
+
+def measure(db, args, ctx):
+    results = {}
+    for name, (sql, params) in QUERIES.items():
+        plan = [row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params(ctx))]
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            db.execute(sql, params(ctx)).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+        results[name] = {'plan': plan, 'median_ms': round(statistics.median(timings), 3)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--usage-rows', type=int, default=1_000_000)
+    parser.add_argument('--sessions', type=int, default=20_000)
+    parser.add_argument('--days', type=int, default=90, help="Spread rows over this many days")
+    parser.add_argument('--range-days', type=float, default=1, help="Dashboard time range queried")
+    parser.add_argument('--repeat', type=int, default=20, help="Timed runs per query")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_query_plans.json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        app = load_app(workdir)
+        rng = random.Random(args.seed)
+        db = sqlite3.connect(os.path.join(workdir, 'bench.db'))
+        app.migrate(db, target=1)
+
+        print(f"Seeding {args.messages:,} messages and {args.usage_rows:,} usage rows...")
+        seed_start = time.perf_counter()
+        sessions = seed(db, args, rng)
+        seed_seconds = time.perf_counter() - seed_start
+        ctx = {'rng': rng, 'sessions': sessions,
+               'since': str(datetime.utcnow() - timedelta(days=args.range_days))}
+
+        before = measure(db, args, ctx)
+        migrate_start = time.perf_counter()
+        version = app.migrate(db)
+        migrate_seconds = time.perf_counter() - migrate_start
+        # One request's worth of queries, then the periodic end-of-connection PRAGMA optimize
+        for sql, params in QUERIES.values():
+            db.execute(sql, params(ctx)).fetchall()
+        app.optimize_db(db)
+        db.close()
+        db = sqlite3.connect(os.path.join(workdir, 'bench.db'))
+        after = measure(db, args, ctx)
+        db.close()
+
+    report = {
+        'messages': args.messages, 'usage_rows': args.usage_rows, 'sessions': args.sessions,
+        'range_days': args.range_days, 'seed_seconds': round(seed_seconds, 1),
+        'schema_version': version, 'migrate_seconds': round(migrate_seconds, 2), 'queries': {},
+    }
+    for name in QUERIES:
+        speedup = before[name]['median_ms'] / after[name]['median_ms'] if after[name]['median_ms'] else None
+        report['queries'][name] = {'before': before[name], 'after': after[name],
+                                   'speedup': round(speedup, 1) if speedup else None}
+        print(f"\n{name}: {before[name]['median_ms']} ms -> {after[name]['median_ms']} ms"
+              f"{f' ({speedup:.1f}x)' if speedup else ''}")
+        print(f"  before: {' / '.join(before[name]['plan'])}")
+        print(f"  after:  {' / '.join(after[name]['plan'])}")
+    print(f"\nMigrations to version {version} took {migrate_seconds:.2f}s on this data")
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
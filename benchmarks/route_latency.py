@@ -0,0 +1,274 @@
+"""Measure throughput and latency of the main routes against a seeded SQLite database.
+
+Seeds a fresh database with `--sessions` chat sessions of `--messages` messages each,
+`--usage-rows` usage metrics spread over the last `--days` days and `--images` stored
+image uploads, then starts the app (`app.run(threaded=True)`, as `main.py` does, or
+`uvicorn asgi:app` with `--server asgi`) against `stub_upstream.py`. Each route is driven
+in turn by `--clients` concurrent clients until `--requests` requests have completed.
+
+    python benchmarks/route_latency.py --sessions 500 --messages 20 --clients 16
+    python benchmarks/route_latency.py --baseline bench_routes_main.json
+
+Everything runs locally; no Ollama or cloud keys are needed. Results (requests/s and
+p50/p95/p99 per route, plus the seed sizes and git commit) are printed and written as
+JSON to `--output`. With `--baseline`, the p50/p95 and throughput changes against an
+earlier results file are printed as well.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'flask-threaded': [sys.executable, '-c',
+                       "import os; from app import app; app.run(host='127.0.0.1', port=int(os.environ['BENCH_PORT']), threaded=True)"],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1',
+             '--port', '{port}', '--log-level', 'warning', '--backlog', '4096'],
+}
+
+# Route name -> function building (method, path, json body) for the i-th request
+ROUTES = {
+    'generate': lambda i, sessions: ('POST', '/generate', {
+        "messages": [], "model": "stub:latest", "stream": False, "session_id": str(uuid.uuid4()),
+        "newMessage": {"role": "user", "content": f"benchmark question {i}"},
+    }),
+    'history': lambda i, sessions: ('GET', f'/history?page={i % 5 + 1}', None),
+    'api_sessions': lambda i, sessions: ('GET', '/api/sessions', None),
+    'session_messages': lambda i, sessions: ('GET', f'/api/session/{sessions[i % len(sessions)]}', None),
+    'dashboard': lambda i, sessions: ('GET', '/dashboard?range=28d', None),
+}
+DEFAULT_ROUTES = 'generate,history,api_sessions,dashboard'
+
+WORDS = ("the model answered with a detailed explanation of configuration retries streaming "
+         "tokens latency cache session history dashboard prompt context budget").split()
+
+# 1x1 transparent PNG; repeated to reach --image-kb
+PNG_BASE64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed_database(path, args, env):
+    """Create the schema by importing the app once, then bulk-insert the seed rows."""
+    subprocess.run([sys.executable, '-c', 'import app'], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    span = timedelta(days=args.days).total_seconds()
+
+    def stamp():
+        return (now - timedelta(seconds=rng.uniform(0, span))).strftime('%Y-%m-%d %H:%M:%S')
+
+    sessions = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(args.sessions)]
+    image_data = PNG_BASE64 * max(1, args.image_kb * 1024 // len(PNG_BASE64))
+    with sqlite3.connect(path) as db:
+        messages = []
+        for session_id in sessions:
+            started = now - timedelta(seconds=rng.uniform(0, span))
+            for n in range(args.messages):
+                timestamp = (started + timedelta(seconds=30 * n)).strftime('%Y-%m-%d %H:%M:%S')
+                if n % 2 == 0:
+                    messages.append((session_id, 'user', sentence(rng, 20), timestamp, None, None, None))
+                else:
+                    messages.append((session_id, 'assistant', sentence(rng, 120), timestamp,
+                                     round(rng.uniform(0.5, 8), 2), 'stub:latest', round(rng.uniform(10, 80), 2)))
+        db.executemany('INSERT INTO messages (session_id, sender, content, timestamp, generation_time, model_used, tokens_per_second) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?)', messages)
+        db.executemany("INSERT INTO messages (session_id, sender, content, timestamp) VALUES (?, 'system', ?, ?)", [
+            (rng.choice(sessions), f"Image uploaded: image_{i}.png\n\n--- IMAGE ---\nimage/png;base64,{image_data}", stamp())
+            for i in range(args.images if sessions else 0)
+        ])
+        models = ['stub:latest', 'llama3.2:3b', '(OpenAI) gpt-4o-mini', '(Perplexity) sonar']
+        db.executemany('INSERT INTO api_usage_metrics (model, category, session_id, input_tokens_per_message, '
+                       'output_tokens_per_message, timestamp) VALUES (?, ?, ?, ?, ?, ?)', [
+            (rng.choice(models), 'chat', rng.choice(sessions) if sessions else 'benchmark',
+             rng.randint(50, 4000), rng.randint(20, 1200), stamp())
+            for _ in range(args.usage_rows)
+        ])
+    return sessions
+
+
+async def run_route(port, route, args, sessions):
+    latencies, failures = [], 0
+    counter = iter(range(args.requests))
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=args.timeout) as client:
+        async def worker():
+            nonlocal failures
+            for i in counter:
+                method, path, body = ROUTES[route](i, sessions)
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body)
+                    await response.aread()
+                except httpx.HTTPError:
+                    failures += 1
+                    continue
+                if response.status_code != 200:
+                    failures += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        # Warm up caches and connections before timing
+        for i in range(min(args.warmup, args.requests)):
+            method, path, body = ROUTES[route](i, sessions)
+            await client.request(method, path, json=body)
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.clients)))
+        wall = time.perf_counter() - wall_start
+
+    return {
+        'requests': args.requests,
+        'succeeded': len(latencies),
+        'failed': failures,
+        'wall_seconds': round(wall, 2),
+        'requests_per_second': round(len(latencies) / wall, 1) if wall else None,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+
+def change(current, baseline):
+    if current is None or not baseline:
+        return '   n/a'
+    return f"{(current - baseline) / baseline * 100:+6.1f}%"
+
+
+def print_comparison(report, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nChange against {baseline_path} (commit {baseline.get('commit')}):")
+    for route, result in report['routes'].items():
+        before = baseline.get('routes', {}).get(route)
+        if not before:
+            continue
+        print(f"  {route:17} p50 {change(result['p50_ms'], before['p50_ms'])}  "
+              f"p95 {change(result['p95_ms'], before['p95_ms'])}  "
+              f"req/s {change(result['requests_per_second'], before['requests_per_second'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--routes', default=DEFAULT_ROUTES, help=f"Comma-separated, from: {', '.join(ROUTES)}")
+    parser.add_argument('--server', choices=SERVERS, default='flask-threaded')
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20, help="Messages per seeded session")
+    parser.add_argument('--usage-rows', type=int, default=20000)
+    parser.add_argument('--images', type=int, default=50, help="Stored image uploads")
+    parser.add_argument('--image-kb', type=int, default=64, help="Base64 size of each seeded image")
+    parser.add_argument('--days', type=int, default=28, help="Spread seeded rows over this many days")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed, so runs are comparable")
+    parser.add_argument('--clients', type=int, default=8, help="Concurrent clients per route")
+    parser.add_argument('--requests', type=int, default=200, help="Timed requests per route")
+    parser.add_argument('--warmup', type=int, default=5, help="Untimed requests per route")
+    parser.add_argument('--delay', type=float, default=0.05, help="Seconds each stub upstream chat takes")
+    parser.add_argument('--timeout', type=float, default=60.0, help="Per-request client timeout")
+    parser.add_argument('--output', default='bench_routes.json')
+    parser.add_argument('--baseline', help="Earlier results file to compare against")
+    args = parser.parse_args()
+    routes = args.routes.split(',')
+    unknown = [route for route in routes if route not in ROUTES]
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)}")
+
+    upstream_port = free_port()
+    stub = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'stub_upstream.py'),
+                             '--port', str(upstream_port), '--delay', str(args.delay)])
+    report = {
+        'commit': git_commit(),
+        'server': args.server,
+        'python': platform.python_version(),
+        'seed': {name: getattr(args, name) for name in ('sessions', 'messages', 'usage_rows', 'images', 'image_kb', 'days', 'seed')},
+        'clients': args.clients,
+        'stub_delay_seconds': args.delay,
+        'routes': {},
+    }
+    try:
+        wait_for_port(upstream_port)
+        with tempfile.TemporaryDirectory() as workdir:
+            port = free_port()
+            # Caching and coalescing would turn repeated /generate calls into no-ops
+            env = dict({'TOP_P': '0.9', 'TOP_K': '40', 'NUM_PREDICT': '64', 'TEMPERATURE': '0'}, **os.environ)
+            env.update(OLLAMA_BASE_URL=f"http://127.0.0.1:{upstream_port}", BENCH_PORT=str(port),
+                       SQLITE_DATABASE=os.path.join(workdir, 'bench.db'), FLASK_DEBUG='false',
+                       RESPONSE_CACHE_ENABLED='false', COALESCE_REQUESTS='false', CONTEXT_SUMMARIZE='false',
+                       WARM_POOL_MODELS='', BATCH_DIR=os.path.join(workdir, 'batch_jobs'),
+                       ADMISSION_OLLAMA_CONCURRENCY=str(args.clients), ADMISSION_QUEUE_SIZE=str(args.clients * 4))
+            print("Seeding database...")
+            seed_start = time.perf_counter()
+            sessions = seed_database(env['SQLITE_DATABASE'], args, env)
+            report['seed_seconds'] = round(time.perf_counter() - seed_start, 2)
+
+            command = [part.format(port=port) for part in SERVERS[args.server]]
+            proc = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for_port(port)
+                for route in routes:
+                    result = asyncio.run(run_route(port, route, args, sessions or [str(uuid.uuid4())]))
+                    print(f"  {route:17} {json.dumps(result)}")
+                    report['routes'][route] = result
+            finally:
+                proc.terminate()
+                proc.wait(timeout=10)
+    finally:
+        stub.terminate()
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        print_comparison(report, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
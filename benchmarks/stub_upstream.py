@@ -0,0 +1,97 @@
+"""Minimal slow Ollama stand-in for benchmarks.
+
+Speaks just enough of `GET /api/tags` and `POST /api/chat` (streaming and non-streaming)
+to drive `/generate`, holding every chat open for `--delay` seconds. Built on bare
+asyncio so the stub itself is never the concurrency bottleneck.
+
+    python benchmarks/stub_upstream.py --port 11500 --delay 5
+"""
+import json
+import asyncio
+import argparse
+
+TAGS = {"models": [{"name": "stub:latest", "model": "stub:latest", "size": 0, "details": {}}]}
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = b''
+    if int(headers.get('content-length', 0)):
+        body = await reader.readexactly(int(headers['content-length']))
+    return method, path.split('?', 1)[0], body
+
+
+def write_response(writer, status, body, content_type='application/json'):
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n".encode('latin-1') + body
+    )
+
+
+async def stream_chat(writer, words, delay):
+    writer.write(
+        b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+        b"Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n"
+    )
+    for word in words:
+        await asyncio.sleep(delay / len(words))
+        chunk = json.dumps({"message": {"role": "assistant", "content": word + " "}, "done": False}).encode() + b"\n"
+        writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        await writer.drain()
+    final = json.dumps({"message": {"role": "assistant", "content": ""}, "done": True,
+                        "prompt_eval_count": 10, "eval_count": len(words)}).encode() + b"\n"
+    writer.write(f"{len(final):x}\r\n".encode() + final + b"\r\n0\r\n\r\n")
+
+
+async def handle(reader, writer, delay):
+    words = "This is a canned benchmark response from the stub upstream.".split()
+    try:
+        while True:
+            request = await read_request(reader)
+            if request is None:
+                break
+            method, path, body = request
+            if method == 'GET' and path == '/api/tags':
+                write_response(writer, '200 OK', json.dumps(TAGS).encode())
+            elif method == 'POST' and path == '/api/chat':
+                payload = json.loads(body or b'{}')
+                if payload.get('stream'):
+                    await stream_chat(writer, words, delay)
+                else:
+                    await asyncio.sleep(delay)
+                    write_response(writer, '200 OK', json.dumps({
+                        "message": {"role": "assistant", "content": ' '.join(words)},
+                        "done": True, "prompt_eval_count": 10, "eval_count": len(words)
+                    }).encode())
+            else:
+                write_response(writer, '404 Not Found', b'{"error": "not found"}')
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port, delay):
+    server = await asyncio.start_server(lambda r, w: handle(r, w, delay), host, port, backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11500)
+    parser.add_argument('--delay', type=float, default=5.0, help="Seconds each chat stays open")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.delay))
@@ -36,6 +36,12 @@ document.addEventListener('DOMContentLoaded', function() {
                                 <span class="slider round"></span>
                             </label>
                         </td>
+                        <td>
+                            <label class="switch" title="${model.pinned ? 'Unpin' : 'Pin'} Model (keep it loaded)${model.resident ? ` · loaded, ${(model.size_vram / 1e9).toFixed(2)} GB VRAM` : ''}">
+                                <input type="checkbox" class="pin-toggle" data-model-name="${model.name}" ${model.pinned ? 'checked' : ''}>
+                                <span class="slider round"></span>
+                            </label>
+                        </td>
                         <td>
                             <button class="delete-model-btn icon-btn" data-model-name="${model.name}" title="Delete Model">
                                 <span class="material-icons">delete_forever</span>
@@ -45,11 +51,11 @@ document.addEventListener('DOMContentLoaded', function() {
                     modelsTableBody.appendChild(row);
                 });
             } else {
-                modelsTableBody.innerHTML = '<tr><td colspan="5" style="text-align: center;">No local models found.</td></tr>';
+                modelsTableBody.innerHTML = '<tr><td colspan="6" style="text-align: center;">No local models found.</td></tr>';
             }
         } catch (error) {
             console.error('Error fetching models:', error);
-            modelsTableBody.innerHTML = `<tr><td colspan="5" style="text-align: center; color: var(--disconnected);">Error fetching models. Is Ollama running?</td></tr>`;
+            modelsTableBody.innerHTML = `<tr><td colspan="6" style="text-align: center; color: var(--disconnected);">Error fetching models. Is Ollama running?</td></tr>`;
         } finally {
             loadingIndicator.style.display = 'none';
             updateMasterToggleState();
@@ -174,6 +180,27 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    // --- Pin Model in the Warm Pool ---
+    async function togglePinned(modelName, isPinned) {
+        try {
+            const response = await fetch('/api/models/warm', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ name: modelName, pinned: isPinned }),
+            });
+            if (!response.ok) {
+                const result = await response.json();
+                throw new Error(result.error || 'Failed to update the warm pool');
+            }
+        } catch (error) {
+            console.error('Error pinning model:', error);
+            alert(`Failed to ${isPinned ? 'pin' : 'unpin'} model: ${error.message}`);
+            // Revert the toggle on error
+            const toggle = document.querySelector(`.pin-toggle[data-model-name="${modelName}"]`);
+            if (toggle) toggle.checked = !isPinned;
+        }
+    }
+
     // --- Toggle All Active State ---
     async function toggleAllActive(isActive) {
         try {
@@ -269,6 +296,10 @@ document.addEventListener('DOMContentLoaded', function() {
         if (deleteBtn) {
             deleteModel(deleteBtn.dataset.modelName);
         }
+        const pinToggle = e.target.closest('.pin-toggle');
+        if (pinToggle) {
+            togglePinned(pinToggle.dataset.modelName, pinToggle.checked);
+        }
         const activeToggle = e.target.closest('.active-toggle');
         if (activeToggle) {
             const modelName = activeToggle.dataset.modelName;
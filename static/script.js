@@ -52,6 +52,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const incognitoBtn = document.getElementById('incognito-toggle-btn');
     const incognitoIcon = document.getElementById('incognito-icon');
     let conversationHistory = [];
+    let historyVersion = null; // Server-side version of conversationHistory, sent instead of the full history
     const sidebarToggle = document.querySelector('.sidebar-toggle-btn');
     const historySidebarToggle = document.getElementById('history-sidebar-toggle');
     const historySidebar = document.querySelector('.history-sidebar');
@@ -60,6 +61,11 @@ document.addEventListener('DOMContentLoaded', function() {
     let abortController = null; // New: for cancelling fetch requests
     let fileContextActive = false;
     let isIncognito = localStorage.getItem('isIncognito') === 'true';
+    // Per-message timing breakdown: open the app once with ?debug=timings to turn it on, ?debug=off to turn it off
+    const debugParam = new URLSearchParams(window.location.search).get('debug');
+    if (debugParam === 'timings') localStorage.setItem('showTimings', 'true');
+    if (debugParam === 'off') localStorage.removeItem('showTimings');
+    const showTimings = localStorage.getItem('showTimings') === 'true';
     let originalTitle = ''; // Will be set at the end of DOMContentLoaded
 
     // --- New: Inject CSS for Typing Animation ---
@@ -217,6 +223,7 @@ document.addEventListener('DOMContentLoaded', function() {
             if (promptContent) {
                 // Clear existing history and add the selected prompt as the system message
                 conversationHistory = [{ role: 'system', content: promptContent }];
+                historyVersion = null;
                 chatbox.innerHTML = ''; // Clear the visual chat
                 addMessage(`**Prompt Activated:** ${selectedOption.textContent}`, false);
             }
@@ -533,6 +540,24 @@ document.addEventListener('DOMContentLoaded', function() {
         messageDiv.appendChild(footer);
     }
 
+    // Add a collapsible table of the server's per-phase timings (milliseconds) to a message
+    function addTimingPanel(messageDiv, timings) {
+        if (!showTimings || !timings) return;
+        const rows = Object.entries(timings).map(([phase, ms]) => `
+            <tr>
+                <td style="padding: 0 1rem 0 0;">${phase}</td>
+                <td style="text-align: right;">${ms.toFixed(1)} ms</td>
+            </tr>`).join('');
+        const panel = document.createElement('details');
+        panel.className = 'thought timing-panel';
+        panel.style.marginTop = '0.5rem';
+        panel.style.fontSize = '0.85em';
+        panel.innerHTML = `
+            <summary style="cursor: pointer; font-weight: 600;">Timings (${(timings.total || 0).toFixed(0)} ms)</summary>
+            <table style="padding-top: 0.5rem;">${rows}</table>`;
+        messageDiv.appendChild(panel);
+    }
+
     // Handle bot response from server
     async function handleBotResponse(data) {
         const thinkingElement = document.getElementById(thinkingMessageId);
@@ -586,6 +611,7 @@ document.addEventListener('DOMContentLoaded', function() {
             role: 'assistant',
             content: botResponse
         });
+        historyVersion = data.history_version || null;
 
         // Store raw content for the copy button, which includes thoughts
         thinkingElement.dataset.rawContent = botResponse;
@@ -627,6 +653,7 @@ document.addEventListener('DOMContentLoaded', function() {
         }
 
         addMessageFooter(thinkingElement, usage, generationTime, modelUsed, tokensPerSecond);
+        addTimingPanel(thinkingElement, data.timings);
         thinkingMessageId = null; // Clear the ID as we've used the placeholder
 
         // Scroll to the bottom to ensure the new message is visible
@@ -666,6 +693,63 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    // Render partial bot output into the thinking placeholder while tokens stream in
+    function renderStreamingText(text) {
+        const thinkingElement = document.getElementById(thinkingMessageId);
+        if (!thinkingElement) return;
+        // Hide reasoning (including a still-open <think> block) until the final render
+        const visibleText = text.replace(/<think>[\s\S]*?(<\/think>|$)/g, '').trim();
+        if (!visibleText) return;
+        thinkingElement.classList.remove('thinking');
+        thinkingElement.innerHTML = formatMessage(visibleText);
+        scrollToBottom();
+    }
+
+    // Read the NDJSON event stream from /generate and return the final 'done' payload
+    async function readGenerationStream(response) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let streamedText = '';
+        let renderScheduled = false;
+
+        const handleEvent = (event) => {
+            if (event.type === 'token') {
+                streamedText += event.content;
+                if (!renderScheduled) {
+                    renderScheduled = true;
+                    requestAnimationFrame(() => {
+                        renderScheduled = false;
+                        renderStreamingText(streamedText);
+                    });
+                }
+            } else if (event.type === 'error') {
+                throw new Error(event.content);
+            } else if (event.type === 'done') {
+                return event;
+            }
+            return null;
+        };
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop(); // Keep any incomplete line for the next chunk
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                const finalEvent = handleEvent(JSON.parse(line));
+                if (finalEvent) return finalEvent;
+            }
+        }
+        if (buffer.trim()) {
+            const finalEvent = handleEvent(JSON.parse(buffer));
+            if (finalEvent) return finalEvent;
+        }
+        throw new Error('The response stream ended unexpectedly.');
+    }
+
     // Send message to server
     async function sendMessage(overrideMessage = null, isRegeneration = false) {
         let message = overrideMessage || userInput.textContent.trim();
@@ -711,19 +795,29 @@ document.addEventListener('DOMContentLoaded', function() {
         const signal = abortController.signal;
 
         try {
-            const response = await fetch('/generate', {
+            const postGenerate = (sendFullHistory) => fetch('/generate', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({ 
-                    messages: conversationHistory,
+                    // Once the server holds the thread, only its version is sent instead of the whole history
+                    ...(sendFullHistory ? { messages: conversationHistory } : { history_version: historyVersion }),
                     model: selectedModel,
                     newMessage: { role: 'user', content: message }, // Send new message separately
                     incognito: isIncognito, // Send incognito status
-                    is_regeneration: isRegeneration // Send regeneration flag
+                    is_regeneration: isRegeneration, // Send regeneration flag
+                    stream: true // Receive tokens as NDJSON events while they are generated
                 }),
                 signal: signal // Pass the abort signal
             });
 
+            const sendVersionOnly = historyVersion && !isIncognito && !isRegeneration;
+            let response = await postGenerate(!sendVersionOnly);
+            if (response.status === 409 && sendVersionOnly) {
+                // The server's copy of the thread diverged (another tab, deleted messages): resend it in full
+                historyVersion = null;
+                response = await postGenerate(true);
+            }
+
             if (!response.ok) {
                 removeThinking(); // On server error, remove the indicator
                 // Handle client disconnect (204 No Content) gracefully
@@ -734,7 +828,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 throw new Error(errorData.error || 'Server error');
             }
 
-            const data = await response.json();
+            const data = await readGenerationStream(response);
             // Add the user message content to the response data for history tracking
             data.user_message_content = message;
             handleBotResponse(data); // This will now update the thinking message
@@ -774,6 +868,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
             if (response.ok) {
                 conversationHistory = [];
+                historyVersion = null;
                 fileContextActive = false;
                 chatbox.innerHTML = '';
                 if (threadMarkerBar) threadMarkerBar.innerHTML = ''; // Clear markers
@@ -786,6 +881,7 @@ document.addEventListener('DOMContentLoaded', function() {
         } catch (error) {
             // Even if the server call fails, reset the frontend state
             conversationHistory = [];
+            historyVersion = null;
             chatbox.innerHTML = '';
             if (threadMarkerBar) threadMarkerBar.innerHTML = ''; // Clear markers
             // Also reset URL to the base path
@@ -1088,6 +1184,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
                 // Populate conversation history and UI
                 conversationHistory = history;
+                historyVersion = null;
                 history.forEach(msg => {
                     if (msg.role === 'assistant') {
                         const botMsgDiv = addMessage(msg.content, 'assistant');